@@ -0,0 +1,31 @@
+# cython: language_level=3
+"""Compiled first-line search over Docs API body content.
+
+Build in place with ``cythonize -i _walk.pyx``; gduntitlerename.py falls
+back to its pure-Python walker when the extension is not built.
+"""
+
+cpdef object first_text(list content, Py_ssize_t limit):
+    """Return the first non-empty line of text in reading order, or None."""
+    cdef dict element, paragraph, elem, text_run, row, cell
+    cdef str text
+    cdef object found
+    for element in content:
+        paragraph = element.get('paragraph')
+        if paragraph is not None:
+            for elem in paragraph.get('elements', []):
+                text_run = elem.get('textRun')
+                if text_run:
+                    text = text_run.get('content')
+                    if text:
+                        text = text.strip()
+                        if text:
+                            # Limit the title to the first line or character limit
+                            return text.split('\n', 1)[0][:limit]
+        elif 'table' in element:
+            for row in element['table'].get('tableRows', []):
+                for cell in row.get('tableCells', []):
+                    found = first_text(cell.get('content', []), limit)
+                    if found is not None:
+                        return found
+    return None
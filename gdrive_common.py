@@ -0,0 +1,225 @@
+import os.path
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import functools
+from typing import List, Dict
+
+import httplib2
+import google_auth_httplib2
+
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+# Define the path to your credentials.json file
+CREDENTIALS_PATH = '/Users/joebanks/Downloads/credentials.json'
+
+# If modifying these SCOPES, delete the file token.json.
+SCOPES = [
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/documents'
+]
+
+# Query matching every Google Doc in the user's Drive
+DOCS_QUERY = "mimeType='application/vnd.google-apps.document'"
+
+# Timeout in seconds for each HTTP request made through the shared connection
+HTTP_TIMEOUT = 30
+
+# Responses that mean "slow down" and are worth retrying
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 5
+
+# Drive reports per-user throttling as HTTP 403 with one of these reasons
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+class TokenBucket:
+    """Token-bucket rate limiter: bursts up to capacity, then paces calls at rate per second."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def reserve(self, tokens: int = 1) -> float:
+        """Claim tokens and return how many seconds the caller must wait before using them."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # Going negative queues later callers behind this one
+        self._tokens -= tokens
+        return max(0.0, -self._tokens / self.rate)
+
+    def take(self, tokens: int = 1):
+        """Block until the tokens are available."""
+        time.sleep(self.reserve(tokens))
+
+# Drive allows 1000 requests per 100 seconds per user
+drive_bucket = TokenBucket(rate=1000 / 100, capacity=100)
+
+# Docs allows 300 read requests per minute per user
+docs_read_bucket = TokenBucket(rate=300 / 60, capacity=20)
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, capped at one minute."""
+    return min(60, 2 ** attempt + random.random())
+
+def is_rate_limited(status: int, content: bytes) -> bool:
+    """Tell throttling apart from real failures, including Drive's 403 rate-limit errors."""
+    if status in RETRY_STATUSES:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(content)['error'].get('errors', [])
+        return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+def execute_with_retry(request, bucket: TokenBucket = drive_bucket, tokens: int = 1):
+    """Execute an API request under the rate limit, retrying with backoff when throttled."""
+    for attempt in range(MAX_RETRIES):
+        bucket.take(tokens)
+        try:
+            return request.execute()
+        except HttpError as error:
+            if not is_rate_limited(error.resp.status, error.content) or attempt == MAX_RETRIES - 1:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning("Rate limited (HTTP %s); retrying in %.1f s.", error.resp.status, delay)
+            time.sleep(delay)
+
+def execute_batch_with_retry(drive_service, requests: Dict[str, object], callback):
+    """Send requests keyed by request_id as one HTTP batch, re-sending throttled subrequests with backoff."""
+    pending = dict(requests)
+    for attempt in range(MAX_RETRIES):
+        throttled = {}
+
+        def _callback(request_id, response, exception):
+            if (isinstance(exception, HttpError) and attempt < MAX_RETRIES - 1
+                    and is_rate_limited(exception.resp.status, exception.content)):
+                throttled[request_id] = pending[request_id]
+            else:
+                callback(request_id, response, exception)
+
+        batch = drive_service.new_batch_http_request(callback=_callback)
+        for request_id, request in pending.items():
+            batch.add(request, request_id=request_id)
+        # Every subrequest in a batch counts against the quota
+        execute_with_retry(batch, tokens=len(pending))
+
+        if not throttled:
+            return
+        delay = backoff_delay(attempt)
+        logging.warning("%d batched requests rate limited; retrying in %.1f s.", len(throttled), delay)
+        time.sleep(delay)
+        pending = throttled
+
+def configure_logging(level: int):
+    """Log to both console and file at the given level, writing from a background thread."""
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [
+        logging.FileHandler("manage_google_docs.log"),  # Log to file
+        logging.StreamHandler()  # Also log to console
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Callers only enqueue records, so async workers never block on disk or console I/O
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on exit
+
+    # The queue handler only renders the message; the listener's handlers apply the format
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+@functools.lru_cache(maxsize=None)
+def get_credentials() -> Credentials:
+    """Authenticate the user once per process and return the credentials."""
+    creds = None
+    # The file token.json stores the user's access and refresh tokens.
+    if os.path.exists('token.json'):
+        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        logging.info("Loaded credentials from 'token.json'.")
+    # If there are no valid credentials, let the user log in.
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                logging.info("Token refreshed successfully.")
+            except Exception as e:
+                logging.error("Failed to refresh token: %s", e)
+                creds = None
+        if not creds:
+            if not os.path.exists(CREDENTIALS_PATH):
+                logging.error("Error: '%s' not found.", CREDENTIALS_PATH)
+                sys.exit(1)
+            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+            creds = flow.run_local_server(port=0)
+            logging.info("New credentials obtained.")
+        # Save the credentials for the next run
+        with open('token.json', 'w') as token:
+            token.write(creds.to_json())
+            logging.info("Credentials saved to 'token.json'.")
+    return creds
+
+@functools.lru_cache(maxsize=None)
+def get_drive_service():
+    """Return a long-lived Drive service object over a single authorized connection."""
+    creds = get_credentials()
+    try:
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        # Load the discovery documents bundled with the client instead of fetching them,
+        # and skip the discovery file cache, which only logs an ImportError on modern installs
+        drive_service = build('drive', 'v3', http=http, cache_discovery=False, static_discovery=True)
+        logging.info("Service objects created successfully.")
+        return drive_service
+    except Exception as e:
+        logging.error("Failed to create service objects: %s", e)
+        sys.exit(1)
+
+def list_google_docs(drive_service, query: str = DOCS_QUERY,
+                     fields: str = 'nextPageToken, files(id, name)') -> List[Dict]:
+    """List all Google Docs matching the query, handling pagination to include all documents."""
+    try:
+        page_token = None
+        docs = []
+
+        while True:
+            response = execute_with_retry(drive_service.files().list(
+                q=query,
+                spaces='drive',
+                fields=fields,
+                pageToken=page_token,
+                pageSize=1000  # Maximum allowed page size
+            ))
+
+            files = response.get('files', [])
+            docs.extend(files)
+            logging.debug("Fetched %d documents in current page.", len(files))
+
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break  # No more pages to fetch
+
+        logging.info("Total Google Docs retrieved: %d", len(docs))
+        return docs
+    except HttpError as error:
+        logging.error('An error occurred while listing documents: %s', error)
+        return []
+    except Exception as e:
+        logging.error('Unexpected error: %s', e)
+        return []
@@ -1,172 +1,177 @@
 from __future__ import print_function
-import os.path
+import asyncio
 import re
-import sys
 import logging
-import time
 
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import aiohttp
+import orjson
 
-from googleapiclient.discovery import build
+from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
 
-# Configure logging to include debug messages and output to both console and file
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG to capture all levels of logs
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("manage_google_docs.log"),  # Log to file
-        logging.StreamHandler()  # Also log to console
-    ]
+from gdrive_common import (
+    DOCS_QUERY, MAX_RETRIES, backoff_delay, configure_logging, docs_read_bucket, drive_bucket,
+    execute_batch_with_retry, get_credentials, get_drive_service, is_rate_limited
 )
 
-# Define the path to your credentials.json file
-CREDENTIALS_PATH = '/Users/joebanks/Downloads/credentials.json'
-
-# If modifying these SCOPES, delete the file token.json.
-SCOPES = [
-    'https://www.googleapis.com/auth/drive',
-    'https://www.googleapis.com/auth/documents'
-]
-
-def authenticate():
-    """Authenticate the user and return the service objects for Drive and Docs APIs."""
-    creds = None
-    # The file token.json stores the user's access and refresh tokens.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        logging.info("Loaded credentials from 'token.json'.")
-    # If there are no valid credentials, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                logging.info("Token refreshed successfully.")
-            except Exception as e:
-                logging.error("Failed to refresh token: %s", e)
-                creds = None
-        if not creds:
-            if not os.path.exists(CREDENTIALS_PATH):
-                logging.error("Error: '%s' not found.", CREDENTIALS_PATH)
-                sys.exit(1)
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
-            creds = flow.run_local_server(port=0)
-            logging.info("New credentials obtained.")
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-            logging.info("Credentials saved to 'token.json'.")
-    
-    try:
-        # Build the service objects
-        drive_service = build('drive', 'v3', credentials=creds)
-        docs_service = build('docs', 'v1', credentials=creds)
-        logging.info("Service objects created successfully.")
-        return drive_service, docs_service
-    except Exception as e:
-        logging.error("Failed to create service objects: %s", e)
-        sys.exit(1)
+configure_logging(logging.INFO)  # Change to DEBUG for more detailed logs
 
-def list_google_docs(drive_service):
-    """List all Google Docs in the user's Drive, handling pagination to include all documents."""
-    try:
-        query = "mimeType='application/vnd.google-apps.document'"
-        page_token = None
-        docs = []
-        
-        while True:
-            response = drive_service.files().list(
-                q=query,
-                spaces='drive',
-                fields='nextPageToken, files(id, name)',
-                pageToken=page_token,
-                pageSize=1000  # Maximum allowed page size
-            ).execute()
-            
-            files = response.get('files', [])
-            docs.extend(files)
-            logging.debug("Fetched %d documents in current page.", len(files))
-            
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break  # No more pages to fetch
-        
-        logging.info("Total Google Docs retrieved: %d", len(docs))
-        return docs
-    except HttpError as error:
-        logging.error('An error occurred while listing documents: %s', error)
-        return []
-    except Exception as e:
-        logging.error('Unexpected error: %s', e)
-        return []
+# Let Drive drop titled documents server-side; is_untitled() still does the exact match
+UNTITLED_DOCS_QUERY = DOCS_QUERY + " and name contains 'Untitled'"
+
+# Only the fields needed to pick and rename documents
+UNTITLED_DOCS_FIELDS = 'nextPageToken, files(id, name)'
+
+# Drive API endpoint used to stream the listing into the workers
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+
+# Docs API endpoint used for the concurrent first-line fetches
+DOCS_API_URL = 'https://docs.googleapis.com/v1/documents/{}'
+
+# Returned by get_first_line when the document could not be read, as opposed to
+# None for a document that was read and has no text; such documents are left alone
+FETCH_FAILED = object()
+
+# Serializes token refreshes so concurrent workers don't all refresh at once
+_refresh_lock = asyncio.Lock()
+
+# Only request the parts of the document walked by get_first_line; tables nested
+# one level inside a table cell are included, deeper nesting is not requested
+DOCS_FIELDS = (
+    'body/content('
+    'paragraph/elements/textRun/content,'
+    'table/tableRows/tableCells/content/paragraph/elements/textRun/content,'
+    'table/tableRows/tableCells/content/table/tableRows/tableCells/content/paragraph/elements/textRun/content,'
+    'sectionBreak)'
+)
+
+# Number of workers, i.e. the maximum number of Docs API fetches in flight at once
+MAX_CONCURRENT_FETCHES = 20
+
+# Listed documents buffered ahead of the workers
+QUEUE_SIZE = 2000
+
+# Adjust this regex based on how your untitled documents are named
+_UNTITLED_RE = re.compile(r'^Untitled(?: document)?$', re.IGNORECASE)
+
+# Characters not allowed in filenames
+_BAD_CHARS_RE = re.compile(r'[\\/*?:"<>|]')
 
 def is_untitled(title):
     """Determine if a document is untitled."""
-    # Adjust this regex based on how your untitled documents are named
-    return re.match(r'^Untitled(?: document)?$', title, re.IGNORECASE) is not None
+    return _UNTITLED_RE.match(title) is not None
+
+def iter_text_runs(content):
+    """Yield text run contents in reading order, descending into table cells."""
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for element in content:
+        paragraph = element.get('paragraph')
+        if paragraph is not None:
+            for elem in paragraph.get('elements', ()):
+                text_run = elem.get('textRun')
+                if text_run and 'content' in text_run:
+                    yield text_run['content']
+        elif 'table' in element:
+            for row in element['table'].get('tableRows', ()):
+                for cell in row.get('tableCells', ()):
+                    yield from iter_text_runs(cell.get('content', ()))
+        elif debug:
+            logging.debug("Skipping non-paragraph/table element: %s", list(element))
+
+def _first_text(content, char_limit):
+    """Return the first non-empty line of text in reading order, or None."""
+    # Stop at the first text run that is non-empty after stripping
+    for text in iter_text_runs(content):
+        text = text.strip()
+        if text:
+            # Limit the title to the first line or character limit
+            return text.split('\n', 1)[0][:char_limit]
+    return None
+
+try:
+    from _walk import first_text  # Compiled walker, built with: cythonize -i _walk.pyx
+except ImportError:
+    first_text = _first_text
+
+async def refresh_credentials(creds, stale_token):
+    """Refresh the access token unless another worker already replaced stale_token."""
+    async with _refresh_lock:
+        if creds.token == stale_token:
+            await asyncio.to_thread(creds.refresh, Request())
+            logging.info("Token refreshed successfully.")
+
+async def fetch_json(session, creds, url, params, bucket):
+    """GET a Google API resource under the rate limit, retrying with backoff when throttled."""
+    refreshed = False
+    attempt = 0
+    while True:
+        await asyncio.sleep(bucket.reserve())
+        # Refresh ahead of expiry; google-auth marks tokens close to expiring as invalid
+        if not creds.valid:
+            await refresh_credentials(creds, creds.token)
+        token = creds.token
+        async with session.get(url, params=params, headers={'Authorization': f'Bearer {token}'}) as response:
+            status = response.status
+            body = await response.read()
+            if status == 401 and not refreshed:
+                refreshed = True
+            elif not is_rate_limited(status, body) or attempt == MAX_RETRIES - 1:
+                # An exhausted retry raises here, so callers never mistake it for "no text"
+                response.raise_for_status()
+                return orjson.loads(body)
+        # Retry outside the response context so the connection is released
+        if status == 401:
+            logging.warning("Access token rejected fetching %s; refreshing and retrying.", url)
+            await refresh_credentials(creds, token)
+            continue
+        delay = backoff_delay(attempt)
+        attempt += 1
+        logging.warning("Rate limited fetching %s (HTTP %d); retrying in %.1f s.", url, status, delay)
+        await asyncio.sleep(delay)
+
+async def iter_google_docs(session, creds):
+    """Yield candidate untitled Google Docs as each page of the listing arrives."""
+    params = {
+        'q': UNTITLED_DOCS_QUERY,
+        'spaces': 'drive',
+        'fields': UNTITLED_DOCS_FIELDS,
+        'pageSize': 1000  # Maximum allowed page size
+    }
+    while True:
+        response = await fetch_json(session, creds, DRIVE_FILES_URL, params, drive_bucket)
+        files = response.get('files', [])
+        logging.debug("Fetched %d documents in current page.", len(files))
+        for doc in files:
+            yield doc
+        
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break  # No more pages to fetch
+        params['pageToken'] = page_token
 
-def get_first_line(docs_service, doc_id, char_limit=100):
-    """Retrieve the first line of the document with comprehensive element handling."""
+async def get_first_line(session, creds, doc_id, char_limit=100):
+    """Retrieve the first line of the document, or FETCH_FAILED if it could not be read."""
     try:
-        document = docs_service.documents().get(documentId=doc_id).execute()
-        content = document.get('body').get('content')
+        document = await fetch_json(
+            session, creds, DOCS_API_URL.format(doc_id), {'fields': DOCS_FIELDS}, docs_read_bucket
+        )
+        content = document.get('body', {}).get('content', [])
         
         logging.info("Fetching content for document ID: %s", doc_id)
         
-        for element_index, element in enumerate(content):
-            if 'paragraph' in element:
-                paragraph = element.get('paragraph')
-                elements = paragraph.get('elements')
-                logging.debug("Processing paragraph %d with %d elements.", element_index, len(elements))
-                
-                for elem_index, elem in enumerate(elements):
-                    text_run = elem.get('textRun')
-                    if text_run and 'content' in text_run:
-                        text = text_run.get('content').strip()
-                        logging.debug("Paragraph %d, Element %d: '%s'", element_index, elem_index, text)
-                        if text:
-                            # Limit the title to the first line or character limit
-                            first_line = text.split('\n')[0][:char_limit]
-                            logging.info("First non-empty text found: '%s'", first_line)
-                            return first_line
-            elif 'table' in element:
-                table = element.get('table')
-                rows = table.get('tableRows', [])
-                if rows:
-                    for row_index, row in enumerate(rows):
-                        cells = row.get('tableCells', [])
-                        for cell_index, cell in enumerate(cells):
-                            cell_content = cell.get('content', [])
-                            for cell_element in cell_content:
-                                if 'paragraph' in cell_element:
-                                    cell_paragraph = cell_element.get('paragraph')
-                                    cell_elements = cell_paragraph.get('elements', [])
-                                    for cell_elem in cell_elements:
-                                        cell_text_run = cell_elem.get('textRun')
-                                        if cell_text_run and 'content' in cell_text_run:
-                                            cell_text = cell_text_run.get('content').strip()
-                                            logging.debug("Table Row %d, Cell %d, Element: '%s'", row_index, cell_index, cell_text)
-                                            if cell_text:
-                                                # Limit the title to the first line or character limit
-                                                first_line = cell_text.split('\n')[0][:char_limit]
-                                                logging.info("First non-empty text found in table: '%s'", first_line)
-                                                return first_line
-            elif 'sectionBreak' in element:
-                logging.debug("Skipping section break at index %d.", element_index)
-                continue
-            else:
-                logging.debug("Skipping non-paragraph/table element at index %d.", element_index)
+        first_line = first_text(content, char_limit)
+        if first_line:
+            logging.info("First non-empty text found: '%s'", first_line)
+            return first_line
         
         logging.warning("No non-empty text found in document ID: %s.", doc_id)
         return None
-    except HttpError as error:
+    except aiohttp.ClientResponseError as error:
         logging.error('An error occurred while fetching document %s: %s', doc_id, error)
-        return None
+        return FETCH_FAILED
     except Exception as e:
         logging.error('Unexpected error while fetching document %s: %s', doc_id, e)
-        return None
+        return FETCH_FAILED
 
 def validate_title(title, max_length=100):
     """Validate and sanitize the extracted title."""
@@ -178,68 +183,130 @@ def validate_title(title, max_length=100):
         logging.warning("Title truncated to %d characters: '%s'", max_length, title)
     # Add more validation rules as needed
     # For example, remove any characters not allowed in filenames
-    title = re.sub(r'[\\/*?:"<>|]', '', title)
+    title = _BAD_CHARS_RE.sub('', title)
     return title
 
-def update_document_title(drive_service, doc_id, new_title):
-    """Update the title of the document."""
+# Maximum number of subrequests Google allows in a single HTTP batch request
+BATCH_LIMIT = 100
+
+def _batch_callback(request_id, response, exception):
+    """Log the outcome of a single update/trash subrequest within a batch."""
+    doc_id, action = request_id.split(':', 1)
+    if exception is not None:
+        if isinstance(exception, HttpError):
+            logging.error('An error occurred while %s document %s: %s', action, doc_id, exception)
+        else:
+            logging.error('Unexpected error while %s document %s: %s', action, doc_id, exception)
+    elif action == 'updating':
+        logging.info("Updated document %s title to: '%s'", doc_id, response.get('name'))
+    else:
+        logging.info("Trashed document %s.", doc_id)
+
+def add_update_title(requests, drive_service, doc_id, new_title):
+    """Queue an update of the document title for the next batch."""
+    requests[f'{doc_id}:updating'] = drive_service.files().update(
+        fileId=doc_id,
+        body={'name': new_title},
+        fields='id, name'
+    )
+
+def add_trash_document(requests, drive_service, doc_id):
+    """Queue moving the document to trash for the next batch."""
+    requests[f'{doc_id}:trashing'] = drive_service.files().update(
+        fileId=doc_id,
+        body={'trashed': True},
+        fields='id'
+    )
+
+def execute_batch(drive_service, requests):
+    """Send all queued subrequests in a single HTTP round-trip, retrying throttled ones."""
     try:
-        drive_service.files().update(
-            fileId=doc_id,
-            body={'name': new_title}
-        ).execute()
-        logging.info("Updated document %s title to: '%s'", doc_id, new_title)
+        execute_batch_with_retry(drive_service, requests, _batch_callback)
     except HttpError as error:
-        logging.error('An error occurred while updating document %s: %s', doc_id, error)
+        logging.error('An error occurred while executing batch request: %s', error)
     except Exception as e:
-        logging.error('Unexpected error while updating document %s: %s', doc_id, e)
+        logging.error('Unexpected error while executing batch request: %s', e)
 
-def trash_document(drive_service, doc_id):
-    """Move the document to trash."""
+async def produce(session, creds, queue):
+    """Feed listed documents into the queue page by page and return how many were listed."""
+    total = 0
     try:
-        drive_service.files().update(
-            fileId=doc_id,
-            body={'trashed': True}
-        ).execute()
-        logging.info("Trashed document %s.", doc_id)
-    except HttpError as error:
-        logging.error('An error occurred while trashing document %s: %s', doc_id, error)
+        async for doc in iter_google_docs(session, creds):
+            await queue.put(doc)
+            total += 1
+    except aiohttp.ClientResponseError as error:
+        logging.error('An error occurred while listing documents: %s', error)
     except Exception as e:
-        logging.error('Unexpected error while trashing document %s: %s', doc_id, e)
+        logging.error('Unexpected error: %s', e)
+    logging.info("Total Google Docs retrieved: %d", total)
+    return total
+
+async def consume(session, creds, queue, first_lines):
+    """Resolve the first line of each untitled document taken from the queue."""
+    while True:
+        doc = await queue.get()
+        doc_id = doc.get('id')
+        title = doc.get('name')
+        try:
+            if not is_untitled(title):
+                logging.info("Skipping document ID: %s with title: '%s'", doc_id, title)
+                continue
+            logging.info("Processing document ID: %s with title: '%s'", doc_id, title)
+            first_line = await get_first_line(session, creds, doc_id)
+            if first_line is FETCH_FAILED:
+                logging.warning("Leaving document %s untouched; its content could not be read.", doc_id)
+            else:
+                first_lines[doc_id] = first_line
+        except Exception as e:
+            logging.error("Unhandled exception while processing document %s: %s", doc_id, e)
+        finally:
+            queue.task_done()
 
-def main():
-    drive_service, docs_service = authenticate()
-    docs = list_google_docs(drive_service)
+async def main():
+    creds = get_credentials()
+    drive_service = get_drive_service()
     
-    if not docs:
+    # Start with a fresh token; fetch_json refreshes again as it nears expiry or on a 401
+    await refresh_credentials(creds, creds.token)
+    
+    # Workers start on the first page while the rest of the listing is still arriving
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    first_lines = {}
+    async with aiohttp.ClientSession() as session:
+        workers = [
+            asyncio.create_task(consume(session, creds, queue, first_lines))
+            for _ in range(MAX_CONCURRENT_FETCHES)
+        ]
+        total = await produce(session, creds, queue)
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    
+    if not total:
         logging.info('No Google Docs found.')
         return
     
-    for doc in docs:
-        doc_id = doc.get('id')
-        title = doc.get('name')
-        if is_untitled(title):
-            logging.info("Processing document ID: %s with title: '%s'", doc_id, title)
-            try:
-                first_line = get_first_line(docs_service, doc_id)
-                if first_line:
-                    validated_title = validate_title(first_line)
-                    if validated_title:
-                        update_document_title(drive_service, doc_id, validated_title)
-                    else:
-                        logging.warning("Validated title is invalid for document %s. Trashing document.", doc_id)
-                        trash_document(drive_service, doc_id)
-                else:
-                    # If no content is found, move the document to trash
-                    trash_document(drive_service, doc_id)
-            except Exception as e:
-                logging.error("Unhandled exception while processing document %s: %s", doc_id, e)
-            finally:
-                # Optional: Introduce a short delay to prevent hitting rate limits
-                time.sleep(0.1)  # Sleep for 100 milliseconds
+    requests = {}
+    for doc_id, first_line in first_lines.items():
+        if first_line:
+            validated_title = validate_title(first_line)
+            if validated_title:
+                add_update_title(requests, drive_service, doc_id, validated_title)
+            else:
+                logging.warning("Validated title is invalid for document %s. Trashing document.", doc_id)
+                add_trash_document(requests, drive_service, doc_id)
         else:
-            logging.info("Skipping document ID: %s with title: '%s'", doc_id, title)
+            # If no content is found, move the document to trash
+            add_trash_document(requests, drive_service, doc_id)
+        # Flush once the batch is full; Google rejects batches over the limit
+        if len(requests) == BATCH_LIMIT:
+            execute_batch(drive_service, requests)
+            requests = {}
+    
+    if requests:
+        execute_batch(drive_service, requests)
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
 
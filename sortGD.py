@@ -1,5 +1,7 @@
-import os
 import re
+import json
+import shelve
+import hashlib
 import sys
 import logging
 import time
@@ -7,32 +9,20 @@ from typing import Optional, List, Dict
 
 from openai import OpenAI
 
-from dotenv import load_dotenv  # Optional: For loading environment variables from a .env file
-
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from gdrive_common import (
+    configure_logging, execute_batch_with_retry, execute_with_retry, get_drive_service, list_google_docs
+)
+
 # Optional: Load environment variables from a .env file
-# Uncomment the following two lines if you're using a .env file
+# Uncomment the following lines if you're using a .env file
+# import os
+# from dotenv import load_dotenv
 # load_dotenv()
 # os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY')
 
-# Configure logging to include debug messages and output to both console and file
-logging.basicConfig(
-    level=logging.INFO,  # Change to DEBUG for more detailed logs
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("manage_google_docs.log"),
-        logging.StreamHandler()
-    ]
-)
-
-# Define the path to your credentials.json file
-CREDENTIALS_PATH = '/Users/joebanks/Downloads/credentials.json'
+configure_logging(logging.INFO)  # Change to DEBUG for more detailed logs
 
 # Define the OpenAI API Key securely
 OPENAI_API_KEY = ''
@@ -50,167 +40,185 @@ CATEGORIES = {
     # Add more categories as needed
 }
 
-# If modifying these SCOPES, delete the file token.json.
-SCOPES = [
-    'https://www.googleapis.com/auth/drive',
-    'https://www.googleapis.com/auth/documents'
-]
-
-def authenticate() -> (object, object):
-    """Authenticate the user and return the service objects for Drive and Docs APIs."""
-    creds = None
-    # The file token.json stores the user's access and refresh tokens.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        logging.info("Loaded credentials from 'token.json'.")
-    # If there are no valid credentials, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                logging.info("Token refreshed successfully.")
-            except Exception as e:
-                logging.error("Failed to refresh token: %s", e)
-                creds = None
-        if not creds:
-            if not os.path.exists(CREDENTIALS_PATH):
-                logging.error("Error: '%s' not found.", CREDENTIALS_PATH)
-                sys.exit(1)
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
-            creds = flow.run_local_server(port=0)
-            logging.info("New credentials obtained.")
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-            logging.info("Credentials saved to 'token.json'.")
+# Maximum number of titles sent to OpenAI in a single categorization request
+CATEGORIZE_BATCH_SIZE = 50
 
-    try:
-        # Build the service objects
-        drive_service = build('drive', 'v3', credentials=creds)
-        docs_service = build('docs', 'v1', credentials=creds)
-        logging.info("Service objects created successfully.")
-        return drive_service, docs_service
-    except Exception as e:
-        logging.error("Failed to create service objects: %s", e)
-        sys.exit(1)
-
-def list_google_docs(drive_service) -> List[Dict]:
-    """List all Google Docs in the user's Drive, handling pagination to include all documents."""
-    try:
-        query = "mimeType='application/vnd.google-apps.document'"
-        page_token = None
-        docs = []
-
-        while True:
-            response = drive_service.files().list(
-                q=query,
-                spaces='drive',
-                fields='nextPageToken, files(id, name)',
-                pageToken=page_token,
-                pageSize=1000  # Maximum allowed page size
-            ).execute()
+# Model and prompts used to categorize titles
+CATEGORIZE_MODEL = "gpt-3.5-turbo"  # You can choose a different model if desired
+CATEGORIZE_SYSTEM_PROMPT = "You are an assistant that categorizes document titles into predefined categories."
+CATEGORIZE_PROMPT = (
+    "Categorize each title into one of: {choices}. "
+    "Respond with a JSON object whose \"categories\" key is an array of the same length, in the same order.\n\n"
+    "{numbered_titles}"
+)
 
-            files = response.get('files', [])
-            docs.extend(files)
-            logging.debug("Fetched %d documents in current page.", len(files))
+# On-disk cache of title -> category results, reused across runs
+CATEGORY_CACHE_PATH = 'title_cat.db'
+CATEGORY_CACHE_TTL = 30 * 86400  # Re-categorize titles after 30 days
 
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break  # No more pages to fetch
+# Cache keys are namespaced by the categories, prompts and model, so changing any
+# of them (e.g. adding a category) invalidates results cached under the old setup
+_CACHE_NAMESPACE = hashlib.blake2b(
+    json.dumps([sorted(CATEGORIES), CATEGORIZE_MODEL, CATEGORIZE_SYSTEM_PROMPT, CATEGORIZE_PROMPT]).encode('utf-8'),
+    digest_size=8
+).hexdigest()
 
-        logging.info("Total Google Docs retrieved: %d", len(docs))
-        return docs
-    except HttpError as error:
-        logging.error('An error occurred while listing documents: %s', error)
-        return []
-    except Exception as e:
-        logging.error('Unexpected error: %s', e)
-        return []
+# Generic titles given to new documents
+_UNTITLED_RE = re.compile(r'^Untitled(?: document)?$', re.IGNORECASE)
 
 def is_meaningful(title: str) -> bool:
     """Determine if a document title is meaningful."""
     # Define criteria for meaningful titles
     # Example: Titles longer than 5 characters and not generic
-    return len(title.strip()) > 5 and not re.match(r'^Untitled(?: document)?$', title, re.IGNORECASE)
+    return len(title.strip()) > 5 and not _UNTITLED_RE.match(title)
 
-def categorize_document(title: str) -> Optional[str]:
-    """Use OpenAI's API to categorize the document based on its title."""
+def categorize_batch(titles: List[str]) -> Optional[List[str]]:
+    """Use OpenAI's API to categorize a batch of documents based on their titles."""
+    choices = ", ".join(list(CATEGORIES) + ["Other"])
+    numbered_titles = "\n".join(f"{i + 1}. {title}" for i, title in enumerate(titles))
     try:
-        response = client.chat.completions.create(model="gpt-3.5-turbo",  # You can choose a different model if desired
+        response = client.chat.completions.create(model=CATEGORIZE_MODEL,
         messages=[
-            {"role": "system", "content": "You are an assistant that categorizes document titles into predefined categories."},
-            {"role": "user", "content": f"Title: {title}\n\nCategory:"},
+            {"role": "system", "content": CATEGORIZE_SYSTEM_PROMPT},
+            {"role": "user", "content": CATEGORIZE_PROMPT.format(choices=choices, numbered_titles=numbered_titles)},
         ],
+        response_format={"type": "json_object"},
         temperature=0.3,
-        max_tokens=10,
+        max_tokens=20 * len(titles),
         n=1)
 
-        category = response.choices[0].message.content.strip()
+        categories = json.loads(response.choices[0].message.content)["categories"]
+        if len(categories) != len(titles):
+            raise ValueError(f"expected {len(titles)} categories, got {len(categories)}")
+    except Exception as e:
+        logging.error("Error during OpenAI categorization for %d titles: %s", len(titles), e)
+        return None
+
+    results = []
+    for title, category in zip(titles, categories):
+        category = str(category).strip()
         logging.info("OpenAI categorization result for '%s': '%s'", title, category)
 
         # Validate if the category is one of the predefined ones
         if category in CATEGORIES:
-            return category
+            results.append(category)
         else:
-            logging.warning("Received unknown category '%s' for title '%s'. Assigning to 'Other'.", category, title)
-            return "Other"
-    except Exception as e:
-        logging.error("Error during OpenAI categorization for title '%s': %s", title, e)
-        return "Other"  # Default to 'Other' in case of error
+            if category != "Other":
+                logging.warning("Received unknown category '%s' for title '%s'. Assigning to 'Other'.", category, title)
+            results.append("Other")
+    return results
+
+def _cache_key(title: str) -> str:
+    """Return the category cache key for a title under the current categorization setup."""
+    return f"{_CACHE_NAMESPACE}:{hashlib.blake2b(title.encode('utf-8'), digest_size=16).hexdigest()}"
+
+def categorize_titles(titles: List[str]) -> List[str]:
+    """Categorize titles, only asking OpenAI about those not already cached."""
+    now = time.time()
+    categories = {}
+    misses = []
+    with shelve.open(CATEGORY_CACHE_PATH) as cache:
+        # Each distinct title is looked up once, even if many documents share it
+        for title in dict.fromkeys(titles):
+            entry = cache.get(_cache_key(title))
+            if entry and now - entry[1] < CATEGORY_CACHE_TTL:
+                categories[title] = entry[0]
+            else:
+                misses.append(title)
+        logging.info("Category cache hits: %d, misses: %d", len(categories), len(misses))
+
+        for start in range(0, len(misses), CATEGORIZE_BATCH_SIZE):
+            chunk = misses[start:start + CATEGORIZE_BATCH_SIZE]
+            results = categorize_batch(chunk)
+            if results is None:
+                # Default to 'Other' in case of error, without caching the fallback
+                categories.update(dict.fromkeys(chunk, "Other"))
+                continue
+            for title, category in zip(chunk, results):
+                categories[title] = category
+                cache[_cache_key(title)] = (category, now)
+
+    return [categories[title] for title in titles]
+
+def get_or_create_folders(drive_service, folder_names: List[str]) -> Dict[str, str]:
+    """Retrieve folder IDs by name with a single listing, creating any that don't exist."""
+    folder_ids = {}
+    try:
+        query = "mimeType='application/vnd.google-apps.folder' and trashed=false"
+        page_token = None
 
-def get_or_create_folder(drive_service, folder_name: str, parent_id: Optional[str] = None) -> Optional[str]:
-    """Retrieve the folder ID by name or create it if it doesn't exist."""
+        while True:
+            response = execute_with_retry(drive_service.files().list(
+                q=query,
+                spaces='drive',
+                fields='nextPageToken, files(id, name)',
+                pageToken=page_token,
+                pageSize=1000  # Maximum allowed page size
+            ))
+
+            for folder in response.get('files', []):
+                if folder.get('name') in folder_names:
+                    # Keep the first match, as a name lookup would
+                    folder_ids.setdefault(folder.get('name'), folder.get('id'))
+
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break  # No more pages to fetch
+    except HttpError as error:
+        logging.error("An error occurred while listing folders: %s", error)
+        return folder_ids
+    except Exception as e:
+        logging.error("Unexpected error while listing folders: %s", e)
+        return folder_ids
+
+    for folder_name, folder_id in folder_ids.items():
+        logging.info("Found existing folder '%s' with ID: %s", folder_name, folder_id)
+
+    missing = [name for name in dict.fromkeys(folder_names) if name not in folder_ids]
+    if not missing:
+        return folder_ids
+
+    def _created(request_id, response, exception):
+        if exception is not None:
+            logging.error("An error occurred while creating folder '%s': %s", request_id, exception)
+            return
+        folder_ids[request_id] = response.get('id')
+        logging.info("Created new folder '%s' with ID: %s", request_id, response.get('id'))
+
+    # Create all missing folders in one round-trip
+    requests = {}
+    for folder_name in missing:
+        file_metadata = {
+            'name': folder_name,
+            'mimeType': 'application/vnd.google-apps.folder'
+        }
+        requests[folder_name] = drive_service.files().create(body=file_metadata, fields='id')
     try:
-        query = f"mimeType='application/vnd.google-apps.folder' and name='{folder_name}'"
-        if parent_id:
-            query += f" and '{parent_id}' in parents"
-
-        results = drive_service.files().list(
-            q=query,
-            spaces='drive',
-            fields='files(id, name)',
-            pageSize=10
-        ).execute()
-
-        folders = results.get('files', [])
-        if folders:
-            folder_id = folders[0].get('id')
-            logging.info("Found existing folder '%s' with ID: %s", folder_name, folder_id)
-            return folder_id
-        else:
-            # Create the folder
-            file_metadata = {
-                'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder'
-            }
-            if parent_id:
-                file_metadata['parents'] = [parent_id]
-
-            folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-            folder_id = folder.get('id')
-            logging.info("Created new folder '%s' with ID: %s", folder_name, folder_id)
-            return folder_id
+        execute_batch_with_retry(drive_service, requests, _created)
     except HttpError as error:
-        logging.error("An error occurred while accessing/creating folder '%s': %s", folder_name, error)
-        return None
+        logging.error("An error occurred while creating folders: %s", error)
     except Exception as e:
-        logging.error("Unexpected error while accessing/creating folder '%s': %s", folder_name, e)
-        return None
+        logging.error("Unexpected error while creating folders: %s", e)
+    return folder_ids
 
-def move_document_to_folder(drive_service, doc_id: str, folder_id: str):
+def move_document_to_folder(drive_service, doc: Dict, folder_id: str):
     """Move the document to the specified folder."""
+    doc_id = doc.get('id')
     try:
-        # Retrieve the existing parents to remove
-        file = drive_service.files().get(fileId=doc_id, fields='parents').execute()
-        previous_parents = ",".join(file.get('parents'))
+        # The existing parents to remove come from the listing, saving a files().get
+        parents = doc.get('parents', [])
+        if parents == [folder_id]:
+            logging.info("Document ID: %s is already in folder ID: %s.", doc_id, folder_id)
+            return
+        previous_parents = ",".join(parents)
 
         # Move the file to the new folder
-        drive_service.files().update(
+        execute_with_retry(drive_service.files().update(
             fileId=doc_id,
             addParents=folder_id,
             removeParents=previous_parents,
             fields='id, parents'
-        ).execute()
+        ))
 
         logging.info("Moved document ID: %s to folder ID: %s.", doc_id, folder_id)
     except HttpError as error:
@@ -219,59 +227,54 @@ def move_document_to_folder(drive_service, doc_id: str, folder_id: str):
         logging.error("Unexpected error while moving document %s: %s", doc_id, e)
 
 def main():
-    drive_service, docs_service = authenticate()
-    docs = list_google_docs(drive_service)
+    drive_service = get_drive_service()
+    docs = list_google_docs(drive_service, fields='nextPageToken, files(id, name, parents)')
 
     if not docs:
         logging.info('No Google Docs found.')
         return
 
-    # Pre-fetch or create target folders
+    # Pre-fetch or create target folders, including 'Other'
+    folder_names = list(CATEGORIES.values()) + ["Other"]
+    found = get_or_create_folders(drive_service, folder_names)
     folder_ids = {}
     for category, folder_name in CATEGORIES.items():
-        folder_id = get_or_create_folder(drive_service, folder_name)
-        if folder_id:
-            folder_ids[category] = folder_id
+        if folder_name in found:
+            folder_ids[category] = found[folder_name]
         else:
             logging.error("Failed to access or create folder for category '%s'. Documents in this category will not be moved.", category)
 
     # Ensure 'Other' folder exists
     if "Other" not in folder_ids:
-        other_folder_id = get_or_create_folder(drive_service, "Other")
-        if other_folder_id:
-            folder_ids["Other"] = other_folder_id
+        if "Other" in found:
+            folder_ids["Other"] = found["Other"]
         else:
             logging.error("Failed to access or create 'Other' folder. Documents categorized as 'Other' will not be moved.")
 
-    for doc in docs:
+    # Categorize the documents using OpenAI based solely on their titles
+    categories = categorize_titles([doc.get('name') for doc in docs])
+
+    for doc, category in zip(docs, categories):
         doc_id = doc.get('id')
         title = doc.get('name')
 
-        logging.info("Processing document ID: %s with title: '%s'", doc_id, title)
+        logging.info("Processing document ID: %s with title: '%s' (category: %s)", doc_id, title, category)
 
         try:
-            # Categorize the document using OpenAI based solely on its title
-            category = categorize_document(title)
-            if not category:
-                category = "Other"
-
             # Get the folder ID for the category, defaulting to 'Other' if necessary
             folder_id = folder_ids.get(category, folder_ids.get("Other"))
             if folder_id:
                 # Move the document to the appropriate folder
-                move_document_to_folder(drive_service, doc_id, folder_id)
+                move_document_to_folder(drive_service, doc, folder_id)
             else:
                 logging.warning("No folder found for category '%s'. Assigning to 'Other'.", category)
                 other_folder_id = folder_ids.get("Other")
                 if other_folder_id:
-                    move_document_to_folder(drive_service, doc_id, other_folder_id)
+                    move_document_to_folder(drive_service, doc, other_folder_id)
                 else:
                     logging.error("No 'Other' folder available to move document %s.", doc_id)
         except Exception as e:
             logging.error("Unhandled exception while processing document %s: %s", doc_id, e)
-        finally:
-            # Optional: Introduce a short delay to prevent hitting rate limits
-            time.sleep(0.1)  # Sleep for 100 milliseconds
 
 if __name__ == '__main__':
     main()